@@ -1,11 +1,19 @@
 import asyncio
 import logging
+import multiprocessing
 import os
 import sys
 
 from filelock import FileLock, Timeout
 
-from src.statistic_collector import StatisticCollector, StatisticConfig
+from src.statistic_collector import (
+    MusicSearchIndex,
+    RecordCompactor,
+    SoakConfig,
+    StatisticCollector,
+    StatisticConfig,
+    run_soak,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +30,15 @@ async def main():
         logging_config["encoding"] = "utf-8"
     logging.basicConfig(**logging_config)
 
+    if "--soak" in sys.argv:
+        soak_config_file = "soak.json"
+        soak_config = SoakConfig()
+        if os.path.exists(soak_config_file):
+            with open(soak_config_file, "r", encoding="utf-8") as fp:
+                soak_config = SoakConfig.model_validate_json(fp.read())
+        report = await run_soak(soak_config)
+        sys.exit(0 if report.passed else 1)
+
     config_file = "config.json"
     if not os.path.exists(config_file):
         default = StatisticConfig()
@@ -36,10 +53,22 @@ async def main():
     dblock = FileLock(dblockfile, timeout=0)
     try:
         with dblock:
+            if "--compact" in sys.argv:
+                RecordCompactor(config).compact()
+                return
+            if "--rebuild-search-index" in sys.argv:
+                if config.search_tokenizer is None:
+                    logger.error("search is disabled, set search_tokenizer first")
+                    return
+                MusicSearchIndex.from_config(config).rebuild()
+                return
             collector = StatisticCollector(config)
             await collector.collect_forever()
     except Timeout:
         logger.critical("database busy")
 
 
-asyncio.run(main())
+if __name__ == "__main__":
+    # --soak 会用 spawn 启动子进程，子进程会重新导入本文件，打包后还需要 freeze_support
+    multiprocessing.freeze_support()
+    asyncio.run(main())
@@ -1,9 +1,18 @@
 from .core import StatisticCollector
-from .models import StatisticConfig
+from .compact import RecordCompactor
+from .search import MusicSearchIndex, SearchResult
+from .soak import run_soak, SoakReport
+from .models import StatisticConfig, SoakConfig
 from .beefweb import BeefwebClient
 
 __all__ = [
     "StatisticConfig",
     "StatisticCollector",
     "BeefwebClient",
+    "RecordCompactor",
+    "MusicSearchIndex",
+    "SearchResult",
+    "SoakConfig",
+    "SoakReport",
+    "run_soak",
 ]
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+import aiohttp
+from pydantic import ValidationError
+
+from .beefweb import BeefwebClient
+from .beefweb.models import PlayerActiveItemInfo
+
+logger = logging.getLogger(__name__)
+
+
+class PlaylistItemCache:
+    """
+    以 (playlistId, index) 为键的播放列表条目元数据缓存
+
+    启用后订阅时只请求一个很短的标识列，当前曲目的元数据从这里查，
+    未命中时通过 get_playlist_items 一次拉取附近的一段条目
+
+    排序、拖动之类的操作不会改变 PlaylistInfo，所以不能只靠 playlists 事件失效，
+    每次命中都要拿标识列核对一遍，对不上就说明这个播放列表的条目变了
+    """
+
+    def __init__(
+        self,
+        client: BeefwebClient,
+        columns: list[str],
+        identity_column: str,
+        window: int,
+    ):
+        self._client = client
+        self._joined_columns = ",".join([*columns, identity_column])
+        self._window = window
+        # (playlistId, index) -> (标识, 列值)
+        self._items: dict[tuple[str, int], tuple[str, list[str]]] = {}
+
+    def invalidate(self):
+        if self._items:
+            logger.debug("playlist item cache invalidated, size=%d", len(self._items))
+        self._items.clear()
+
+    def _invalidate_playlist(self, playlist_id: str):
+        self._items = {k: v for k, v in self._items.items() if k[0] != playlist_id}
+        logger.debug("playlist item cache invalidated, playlist=%s", playlist_id)
+
+    async def resolve(self, active_item: PlayerActiveItemInfo) -> list[str] | None:
+        """
+        返回当前曲目的列值
+
+        返回 None 表示缓存给不出元数据（曲目已不在播放列表里、请求失败等），不代表停止
+        """
+        playlist_id = active_item["playlistId"]
+        index = active_item["index"]
+        if not playlist_id or index < 0 or not active_item["columns"]:
+            return None
+        identity = active_item["columns"][0]
+        key = (playlist_id, index)
+        entry = self._items.get(key)
+        if entry is not None and entry[0] != identity:
+            self._invalidate_playlist(playlist_id)
+            entry = None
+        if entry is None:
+            await self._fetch(playlist_id, index)
+            entry = self._items.get(key)
+        if entry is None or entry[0] != identity:
+            return None
+        return entry[1]
+
+    async def _fetch(self, playlist_id: str, index: int):
+        # 顺序播放时下一首大概率就在后面，所以顺便多拉一段
+        try:
+            response = await self._client.get_playlist_items(
+                playlist_id, f"{index}:{self._window}", self._joined_columns
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValidationError) as e:
+            logger.warning("failed to fetch playlist items: %s", e)
+            return
+        items = response.playlistItems
+        for i, item in enumerate(items["items"]):
+            columns = item["columns"]
+            self._items[(playlist_id, items["offset"] + i)] = (
+                columns[-1],
+                columns[:-1],
+            )
+        logger.debug(
+            "cached %d items of playlist %s from %d",
+            len(items["items"]),
+            playlist_id,
+            items["offset"],
+        )
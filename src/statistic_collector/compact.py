@@ -0,0 +1,197 @@
+from dataclasses import dataclass
+import logging
+import time
+import uuid
+
+from sqlalchemy import and_, func, or_, update
+from sqlmodel import Session, col, select
+
+from .database import create_db_engine
+from .models import (
+    StatisticConfig,
+    PlaybackRecord,
+    PlaybackFragment,
+    CompactionCheckpoint,
+)
+
+_CHECKPOINT_NAME = "compact"
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Chain:
+    """同一首歌的一串可合并记录，record 为合并的目标"""
+
+    record: PlaybackRecord
+    end: float
+    has_fragments: bool
+
+
+@dataclass(frozen=True)
+class CompactionResult:
+    scanned: int
+    merged: int
+    checkpoint: float
+
+
+class RecordCompactor:
+    """
+    离线压缩播放记录
+
+    收集时每次暂停都会写入一条记录，所以一次带暂停的播放会被拆成好几条
+    这里按时间顺序扫描每首歌的记录，把间隔小于阈值的片段合并回一条，
+    原始片段记录到 PlaybackFragment 里
+
+    需要在收集器没有运行时执行（即持有数据库锁），否则检查点可能会漏掉还在缓冲区里的记录
+    """
+
+    def __init__(self, config: StatisticConfig):
+        self._config = config.model_copy(deep=True)
+        self._engine = create_db_engine(self._config.database_url)
+        self._threshold = self._config.compact_gap_threshold
+        self._batch_size = self._config.compact_batch_size
+
+    def compact(self) -> CompactionResult:
+        run_time = time.time()
+        scanned = merged = 0
+        chains: dict[str, _Chain] = {}
+        # 要跨多个事务持有链头，所以不能在提交时过期
+        with Session(self._engine, expire_on_commit=False) as session:
+            checkpoint = session.get(CompactionCheckpoint, _CHECKPOINT_NAME)
+            start = None
+            if checkpoint is not None:
+                if checkpoint.gap_threshold == self._threshold:
+                    start = checkpoint.time
+                else:
+                    logger.warning(
+                        "gap threshold changed from %s to %s, compact from scratch",
+                        checkpoint.gap_threshold,
+                        self._threshold,
+                    )
+            logger.info("compact from checkpoint %s", start)
+            cursor: tuple[float, uuid.UUID] | None = None
+            while batch := self._next_batch(session, start, cursor):
+                fragment_ends = self._fragment_ends(session, batch)
+                for record in batch:
+                    scanned += 1
+                    has_fragments = record.id in fragment_ends
+                    end = max(
+                        record.time + record.duration,
+                        fragment_ends.get(record.id, record.time),
+                    )
+                    chain = chains.get(record.music_id)
+                    if chain is not None and record.time - chain.end < self._threshold:
+                        self._merge(session, chain, record, end, has_fragments)
+                        merged += 1
+                    else:
+                        chains[record.music_id] = _Chain(record, end, has_fragments)
+                cursor = (batch[-1].time, batch[-1].id)
+                chains = self._prune(chains, cursor[0])
+                self._save_checkpoint(session, chains, cursor[0])
+                session.commit()
+                logger.debug("batch committed, scanned=%d, merged=%d", scanned, merged)
+            chains = self._prune(chains, run_time)
+            new_checkpoint = self._save_checkpoint(session, chains, run_time)
+            session.commit()
+        logger.info(
+            "compact finished, scanned=%d, merged=%d, checkpoint=%.3f",
+            scanned,
+            merged,
+            new_checkpoint,
+        )
+        return CompactionResult(
+            scanned=scanned, merged=merged, checkpoint=new_checkpoint
+        )
+
+    def _next_batch(
+        self,
+        session: Session,
+        start: float | None,
+        cursor: tuple[float, uuid.UUID] | None,
+    ):
+        # 按 (time, id) 翻页，合并时删掉的记录不会影响游标
+        stmt = (
+            select(PlaybackRecord)
+            .order_by(col(PlaybackRecord.time), col(PlaybackRecord.id))
+            .limit(self._batch_size)
+        )
+        if start is not None:
+            stmt = stmt.where(col(PlaybackRecord.time) >= start)
+        if cursor is not None:
+            stmt = stmt.where(
+                or_(
+                    col(PlaybackRecord.time) > cursor[0],
+                    and_(
+                        col(PlaybackRecord.time) == cursor[0],
+                        col(PlaybackRecord.id) > cursor[1],
+                    ),
+                )
+            )
+        return session.exec(stmt).all()
+
+    @staticmethod
+    def _fragment_ends(session: Session, batch: list[PlaybackRecord]):
+        """已经合并过的记录的实际结束时间要从片段里算"""
+        stmt = (
+            select(
+                PlaybackFragment.record_id,
+                func.max(col(PlaybackFragment.time) + col(PlaybackFragment.duration)),
+            )
+            .where(col(PlaybackFragment.record_id).in_([r.id for r in batch]))
+            .group_by(col(PlaybackFragment.record_id))
+        )
+        return {record_id: end for record_id, end in session.exec(stmt).all()}
+
+    @staticmethod
+    def _merge(
+        session: Session,
+        chain: _Chain,
+        record: PlaybackRecord,
+        end: float,
+        has_fragments: bool,
+    ):
+        head = chain.record
+        if not chain.has_fragments:
+            session.add(
+                PlaybackFragment(
+                    record_id=head.id, time=head.time, duration=head.duration
+                )
+            )
+            chain.has_fragments = True
+        if has_fragments:
+            session.exec(
+                update(PlaybackFragment)
+                .where(col(PlaybackFragment.record_id) == record.id)
+                .values(record_id=head.id)
+            )
+        else:
+            session.add(
+                PlaybackFragment(
+                    record_id=head.id, time=record.time, duration=record.duration
+                )
+            )
+        head.duration += record.duration
+        chain.end = max(chain.end, end)
+        session.add(head)
+        session.delete(record)
+        logger.debug(
+            "merge record %s into %s, duration=%.3f", record.id, head.id, head.duration
+        )
+
+    def _prune(self, chains: dict[str, _Chain], now: float):
+        """丢掉已经不可能再吸收后续记录的链，免得内存跟着历史长度涨"""
+        return {k: c for k, c in chains.items() if c.end + self._threshold > now}
+
+    def _save_checkpoint(self, session: Session, chains: dict[str, _Chain], now: float):
+        # 还可能继续合并的链要在下次重新扫描到
+        new_time = min([now, *(c.record.time for c in chains.values())])
+        checkpoint = session.get(CompactionCheckpoint, _CHECKPOINT_NAME)
+        if checkpoint is None:
+            checkpoint = CompactionCheckpoint(
+                name=_CHECKPOINT_NAME, time=new_time, gap_threshold=self._threshold
+            )
+        else:
+            checkpoint.time = new_time
+            checkpoint.gap_threshold = self._threshold
+        session.add(checkpoint)
+        return new_time
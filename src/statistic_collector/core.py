@@ -2,20 +2,20 @@ import asyncio
 from dataclasses import dataclass
 import json
 import logging
-import sys
 import time
 
 import aiohttp
-from sqlmodel import create_engine, SQLModel, Session
+from pydantic import ValidationError
+from sqlmodel import Session
 
 from .beefweb import BeefwebClient
-from .beefweb.models import PlaybackState, PlayerStateInfo
+from .beefweb.models import PlaybackState, PlayerStateInfo, QueryParams
+from .cache import PlaylistItemCache
+from .database import create_db_engine
 from .models import StatisticConfig, MusicItem, PlaybackRecord
+from .search import MusicSearchIndex
 from .utils import calc_music_id, handle_artist_field, lock
 
-_TABLES_TO_CREATE = [
-    SQLModel.metadata.tables[t.__tablename__] for t in (MusicItem, PlaybackRecord)
-]
 _REQUIRED_FIELDS = [
     r"%title%",
     r"%artist%",
@@ -47,11 +47,13 @@ class StatisticCollector:
             password=self._config.password,
         )
 
-        dburl = self._config.database_url
-        self._engine = create_engine(dburl, echo="--debug" in sys.argv)
-        SQLModel.metadata.create_all(
-            bind=self._engine, tables=_TABLES_TO_CREATE, checkfirst=True
-        )
+        self._engine = create_db_engine(self._config.database_url)
+        # 搜索是可选功能，用不了就关掉，别影响收集
+        self._search_index: MusicSearchIndex | None = None
+        if self._config.search_tokenizer is not None:
+            search_index = MusicSearchIndex(self._engine, self._config.search_tokenizer)
+            if search_index.ensure():
+                self._search_index = search_index
 
         self._columns_as_id = [c.lower().strip() for c in self._config.columns_as_id]
         self._query_columns = self._columns_as_id.copy()
@@ -59,6 +61,30 @@ class StatisticCollector:
             if field not in self._query_columns:
                 self._query_columns.append(field)
 
+        self._item_cache: PlaylistItemCache | None = None
+        # 缓存模式下上一次成功补全的标识和列值，标识没变但拿不到元数据时沿用
+        self._last_identity: str | None = None
+        self._last_columns: list[str] | None = None
+        if self._config.cache_playlist_items:
+            # trcolumns 只请求标识列，播放列表变动时会收到 playlists 事件，借此让缓存失效
+            identity_column = self._config.playlist_cache_identity_column
+            self._item_cache = PlaylistItemCache(
+                self._client,
+                self._query_columns,
+                identity_column,
+                self._config.playlist_cache_window,
+            )
+            self._query_params: QueryParams = {
+                "player": True,
+                "trcolumns": identity_column,
+                "playlists": True,
+            }
+        else:
+            self._query_params = {
+                "player": True,
+                "trcolumns": ",".join(self._query_columns),
+            }
+
         self._last_state: PlayerState | None = None
         # 用于当前曲目的状态缓冲，切歌/停止/断连时整理写入到数据库并清空
         self._buffer: list[PlayerState] = []
@@ -124,6 +150,8 @@ class StatisticCollector:
                     duration=duration,
                 )
             )
+            if self._search_index is not None:
+                self._search_index.add(session, music_id)
             logger.debug("add new music, metadata=%s", metadata)
 
     @property
@@ -236,15 +264,57 @@ class StatisticCollector:
             music_id=music_id,
         )
 
+    async def _resolve_columns(self, player: PlayerStateInfo) -> list[str]:
+        """
+        缓存模式下补全当前曲目的列值
+
+        缓存给不出元数据时先单独问一次播放器，还不行的话：
+        标识列没变就沿用上一次的元数据，免得被当成停止把一次播放切断；
+        标识列变了说明已经切歌，返回空列表让这次播放先结算，绝不把旧元数据安到新曲目上
+        """
+        assert self._item_cache is not None
+        active_item = player["activeItem"]
+        identity = active_item["columns"][0] if active_item["columns"] else None
+        if player["playbackState"] == "stopped":
+            self._last_identity = self._last_columns = None
+            return []
+        columns = await self._item_cache.resolve(active_item)
+        if columns is None:
+            logger.debug("playlist item cache missed, query player directly")
+            columns = await self._fetch_player_columns()
+        if columns is None:
+            if identity is not None and identity == self._last_identity:
+                logger.warning("metadata unavailable, keep previous metadata")
+                return self._last_columns or []
+            logger.warning("metadata unavailable for a new track")
+            self._last_identity = self._last_columns = None
+            return []
+        self._last_identity = identity
+        self._last_columns = columns
+        return columns
+
+    async def _fetch_player_columns(self):
+        try:
+            response = await self._client.get_player(",".join(self._query_columns))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValidationError) as e:
+            logger.warning("failed to fetch player columns: %s", e)
+            return None
+        columns = response.player["activeItem"]["columns"]
+        return columns if len(columns) == len(self._query_columns) else None
+
     @lock()
     async def collect_forever(self):
         try:
             while True:
                 try:
                     async for response in self._client.query_updates(
-                        player=True,
-                        trcolumns=",".join(self._query_columns),
+                        **self._query_params
                     ):
+                        if (
+                            self._item_cache is not None
+                            and response.playlists is not None
+                        ):
+                            self._item_cache.invalidate()
                         player = response.player
                         if player is None:
                             continue
@@ -252,6 +322,10 @@ class StatisticCollector:
                             "receive sse report, data=%s",
                             json.dumps(player, ensure_ascii=False, indent=2),
                         )
+                        if self._item_cache is not None:
+                            player["activeItem"]["columns"] = (
+                                await self._resolve_columns(player)
+                            )
                         self._switch_state(self._player_to_state(player))
                 except aiohttp.ClientConnectionError as e:
                     logger.warning("exception when collecting: %s", e)
@@ -259,9 +333,11 @@ class StatisticCollector:
                 logger.debug(f"retry after {self._config.retry_interval}s")
                 await asyncio.sleep(self._config.retry_interval)
         finally:
-            await self.close()
             self._flush_buffer()
+            await self.close()
             logger.info("stop collecting")
 
     async def close(self):
+        """关闭到 beefweb 的连接并释放数据库连接池"""
         await self._client.close()
+        self._engine.dispose()
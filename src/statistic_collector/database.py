@@ -0,0 +1,25 @@
+import sys
+
+from sqlalchemy import Engine
+from sqlmodel import create_engine, SQLModel
+
+from .models import MusicItem, PlaybackRecord, PlaybackFragment, CompactionCheckpoint
+
+_TABLES_TO_CREATE = [
+    SQLModel.metadata.tables[t.__tablename__]
+    for t in (MusicItem, PlaybackRecord, PlaybackFragment, CompactionCheckpoint)
+]
+
+
+def create_db_engine(database_url: str) -> Engine:
+    """
+    创建数据库引擎并补齐缺失的表和索引
+
+    create_all 不会给已经存在的表补建新加的索引，所以这里单独再检查一遍
+    """
+    engine = create_engine(database_url, echo="--debug" in sys.argv)
+    SQLModel.metadata.create_all(bind=engine, tables=_TABLES_TO_CREATE, checkfirst=True)
+    for table in _TABLES_TO_CREATE:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    return engine
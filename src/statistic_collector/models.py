@@ -1,3 +1,4 @@
+from typing import Literal
 import uuid
 from pydantic import BaseModel
 from sqlmodel import SQLModel, Field, Relationship
@@ -23,6 +24,46 @@ class StatisticConfig(BaseModel):
     database_artist_delimiter: str = "|"
     # 重试间隔
     retry_interval: float = Field(2.0, ge=0.0)
+    # 订阅时只请求最少的字段，元数据从本地的播放列表条目缓存中查
+    cache_playlist_items: bool = False
+    # 缓存未命中时一次拉取的播放列表条目数
+    playlist_cache_window: int = Field(64, gt=0)
+    # 缓存模式下订阅的唯一列，用来核对缓存的条目是不是当前曲目，应当短且唯一
+    playlist_cache_identity_column: str = r"$crc32(%path%):%subsong%"
+
+    # 全文搜索的分词器，CJK 标题多的话用 trigram（需要 SQLite 3.34+），为 None 时不启用搜索
+    search_tokenizer: Literal["unicode61", "trigram"] | None = None
+
+    # 离线压缩时，同一首歌的两段记录间隔小于此秒数即视为同一次播放
+    compact_gap_threshold: float = Field(60.0, ge=0.0)
+    # 离线压缩时每个事务处理的记录数
+    compact_batch_size: int = Field(1000, gt=0)
+
+
+class SoakConfig(BaseModel):
+    # 总时长和预热时长，预热期间的采样不参与判定
+    duration: float = Field(600.0, gt=0.0)
+    warmup: float = Field(30.0, ge=0.0)
+    # 采样间隔
+    sample_interval: float = Field(5.0, gt=0.0)
+    # 合成 SSE 服务器每秒发出的事件数，默认值在单核机器上也留有余量
+    events_per_second: float = Field(1000.0, gt=0.0)
+    # 合成播放器的随机种子，固定下来才能拿前后两次的结果做比较，为 None 时不固定
+    seed: int | None = 0
+    # 合成播放器的曲库大小
+    track_count: int = Field(200, gt=0)
+    # 每个事件发生切歌/暂停(或恢复)/停止/断连的概率
+    switch_probability: float = Field(0.001, ge=0.0, le=1.0)
+    pause_probability: float = Field(0.0005, ge=0.0, le=1.0)
+    stop_probability: float = Field(0.0001, ge=0.0, le=1.0)
+    disconnect_probability: float = Field(0.00005, ge=0.0, le=1.0)
+    # 失败阈值，RSS 在拿不到的平台上不检查
+    max_traced_growth_mb: float = Field(5.0, ge=0.0)
+    max_rss_growth_mb: float = Field(20.0, ge=0.0)
+    # 延迟从合成服务器发出算起，收集器跟不上时包含排队的时间
+    max_p99_latency_ms: float = Field(250.0, gt=0.0)
+    # 实际事件速率低于 events_per_second 的这个比例就算失败，免得收集器变慢反而降低了压力
+    min_rate_ratio: float = Field(0.9, ge=0.0, le=1.0)
 
 
 class MusicItem(SQLModel, table=True):
@@ -36,8 +77,31 @@ class MusicItem(SQLModel, table=True):
 
 class PlaybackRecord(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
-    music_id: str = Field(foreign_key="musicitem.id")
+    music_id: str = Field(foreign_key="musicitem.id", index=True)
     music: MusicItem = Relationship(back_populates="records")
 
-    time: float  # 开始听的时间戳
+    time: float = Field(index=True)  # 开始听的时间戳
     duration: float  # 听的时长，不一定等于歌曲时长
+    fragments: list["PlaybackFragment"] = Relationship(
+        back_populates="record", cascade_delete=True
+    )
+
+
+class PlaybackFragment(SQLModel, table=True):
+    """被压缩合并进某条 PlaybackRecord 的原始播放片段"""
+
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    record_id: uuid.UUID = Field(foreign_key="playbackrecord.id", index=True)
+    record: PlaybackRecord = Relationship(back_populates="fragments")
+
+    time: float  # 片段开始的时间戳
+    duration: float  # 片段的时长
+
+
+class CompactionCheckpoint(SQLModel, table=True):
+    """离线压缩的进度，早于 time 开始的记录都已经不会再被合并"""
+
+    name: str = Field(primary_key=True)
+    time: float
+    # 检查点是按这个间隔阈值算出来的，阈值变了就得从头扫描
+    gap_threshold: float | None = None
@@ -0,0 +1,196 @@
+from dataclasses import dataclass
+import logging
+from typing import Literal
+
+from sqlalchemy import Engine, func, or_, text
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, col, select
+
+from .database import create_db_engine
+from .models import StatisticConfig, MusicItem, PlaybackRecord
+
+SearchTokenizer = Literal["unicode61", "trigram"]
+_FTS_TABLE = "musicitem_fts"
+# trigram 分词器匹配不了少于三个字符的词
+_TRIGRAM_MIN_LENGTH = 3
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SearchResult:
+    music: MusicItem
+    play_count: int
+
+
+class MusicSearchIndex:
+    """
+    MusicItem 的 FTS5 全文索引
+
+    用外部内容表的形式建在 musicitem 上，不额外存一份文本
+    unicode61 按词切分，CJK 标题会整句算一个词，所以曲库里中日文多的话用 trigram
+
+    musicitem 的主键是文本，索引只能挂在隐式的 rowid 上，而 VACUUM 不保证 rowid 不变，
+    所以 VACUUM 之后要重建索引（ensure 能发现条目数或最大 rowid 对不上的情况）
+    """
+
+    def __init__(self, engine: Engine, tokenizer: SearchTokenizer = "trigram"):
+        self._engine = engine
+        self._tokenizer = tokenizer
+
+    @classmethod
+    def from_config(cls, config: StatisticConfig):
+        if config.search_tokenizer is None:
+            raise ValueError("search is disabled, set search_tokenizer first")
+        return cls(create_db_engine(config.database_url), config.search_tokenizer)
+
+    def ensure(self) -> bool:
+        """
+        索引不存在、分词器变了或者和 musicitem 对不上（比如关掉搜索期间加了新歌）就重建
+
+        返回索引是否可用，非 SQLite 数据库或者 SQLite 不支持 FTS5/trigram 时为 False
+        """
+        if self._engine.dialect.name != "sqlite":
+            logger.warning("full-text search requires sqlite, search disabled")
+            return False
+        try:
+            with Session(self._engine) as session:
+                sql = (
+                    session.connection()
+                    .execute(
+                        text("SELECT sql FROM sqlite_master WHERE name = :name"),
+                        {"name": _FTS_TABLE},
+                    )
+                    .scalar()
+                )
+                stale = (
+                    sql is None
+                    or f"tokenize='{self._tokenizer}'" not in sql
+                    or self._is_drifted(session)
+                )
+            if stale:
+                self.rebuild()
+        except OperationalError as e:
+            logger.warning("full-text search unavailable, search disabled: %s", e)
+            return False
+        return True
+
+    @staticmethod
+    def _is_drifted(session: Session):
+        """比较索引和 musicitem 的条目数与最大 rowid，只在启动时查一次"""
+        conn = session.connection()
+        indexed = conn.execute(
+            text(f"SELECT count(*), max(id) FROM {_FTS_TABLE}_docsize")
+        ).one()
+        actual = conn.execute(
+            text(f"SELECT count(*), max(rowid) FROM {MusicItem.__tablename__}")
+        ).one()
+        if tuple(indexed) != tuple(actual):
+            logger.info("search index drifted, indexed=%s, actual=%s", indexed, actual)
+            return True
+        return False
+
+    def rebuild(self):
+        with Session(self._engine) as session:
+            conn = session.connection()
+            conn.execute(text(f"DROP TABLE IF EXISTS {_FTS_TABLE}"))
+            conn.execute(
+                text(
+                    f"CREATE VIRTUAL TABLE {_FTS_TABLE} USING fts5("
+                    "title, artists, album, "
+                    f"content='{MusicItem.__tablename__}', "
+                    f"tokenize='{self._tokenizer}')"
+                )
+            )
+            conn.execute(
+                text(f"INSERT INTO {_FTS_TABLE}({_FTS_TABLE}) VALUES ('rebuild')")
+            )
+            session.commit()
+        logger.info("search index rebuilt, tokenizer=%s", self._tokenizer)
+
+    @staticmethod
+    def add(session: Session, music_id: str):
+        """把刚加入的 MusicItem 同步进索引，和它在同一个事务里提交"""
+        session.flush()
+        session.connection().execute(
+            text(
+                f"INSERT INTO {_FTS_TABLE}(rowid, title, artists, album) "
+                f"SELECT rowid, title, artists, album FROM {MusicItem.__tablename__} "
+                "WHERE id = :id"
+            ),
+            {"id": music_id},
+        )
+
+    def search(self, query: str, limit: int = 50) -> list[SearchResult]:
+        """
+        按标题/艺术家/专辑搜索，多个词之间是“且”的关系
+
+        走索引时按相关度排序，词太短只能退回 LIKE 时按播放次数和标题排序
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        with Session(self._engine) as session:
+            if self._tokenizer == "trigram" and any(
+                len(t) < _TRIGRAM_MIN_LENGTH for t in terms
+            ):
+                return self._search_like(session, terms, limit)
+            return self._search_fts(session, terms, limit)
+
+    def _match_expr(self, terms: list[str]):
+        quoted = ['"' + t.replace('"', '""') + '"' for t in terms]
+        if self._tokenizer == "unicode61":
+            # unicode61 下只能做前缀匹配
+            quoted = [q + "*" for q in quoted]
+        return " ".join(quoted)
+
+    def _search_fts(self, session: Session, terms: list[str], limit: int):
+        # 先在索引里取出前 limit 条再去连表计数，免得对所有命中都做一遍聚合
+        rows = (
+            session.connection()
+            .execute(
+                text(
+                    "SELECT m.id, count(r.id) FROM ("
+                    f"SELECT rowid, rank FROM {_FTS_TABLE} "
+                    f"WHERE {_FTS_TABLE} MATCH :match ORDER BY rank LIMIT :limit"
+                    f") AS f JOIN {MusicItem.__tablename__} AS m ON m.rowid = f.rowid "
+                    f"LEFT JOIN {PlaybackRecord.__tablename__} AS r "
+                    "ON r.music_id = m.id "
+                    "GROUP BY m.id ORDER BY f.rank"
+                ),
+                {"match": self._match_expr(terms), "limit": limit},
+            )
+            .all()
+        )
+        items = {
+            item.id: item
+            for item in session.exec(
+                select(MusicItem).where(col(MusicItem.id).in_([r[0] for r in rows]))
+            ).all()
+        }
+        return [SearchResult(music=items[i], play_count=c) for i, c in rows]
+
+    @staticmethod
+    def _search_like(session: Session, terms: list[str], limit: int):
+        stmt = (
+            select(MusicItem, func.count(col(PlaybackRecord.id)))
+            .outerjoin(PlaybackRecord)
+            .group_by(col(MusicItem.id))
+            .order_by(
+                func.count(col(PlaybackRecord.id)).desc(),
+                col(MusicItem.title),
+                col(MusicItem.id),
+            )
+            .limit(limit)
+        )
+        for term in terms:
+            stmt = stmt.where(
+                or_(
+                    col(MusicItem.title).contains(term, autoescape=True),
+                    col(MusicItem.artists).contains(term, autoescape=True),
+                    col(MusicItem.album).contains(term, autoescape=True),
+                )
+            )
+        return [
+            SearchResult(music=item, play_count=count)
+            for item, count in session.exec(stmt).all()
+        ]
@@ -0,0 +1,395 @@
+import asyncio
+from dataclasses import dataclass, field
+import json
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection
+from multiprocessing.sharedctypes import Synchronized
+from multiprocessing.synchronize import Event as EventType
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+from .beefweb.models import PlaybackState, PlayerStateInfo
+from .core import StatisticCollector
+from .models import SoakConfig, StatisticConfig
+
+_LENGTH_FIELD = r"%length_seconds_fp%"
+# 单次最多补发多少个周期的事件，收集器跟不上时别在服务器这边越积越多
+_MAX_CATCHUP_TICKS = 10
+_TICK = 0.01
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SoakSample:
+    elapsed: float
+    events: int
+    # 这个采样周期内实际发出的事件速率
+    events_per_second: float
+    traced_bytes: int
+    rss_bytes: int | None
+    p99_latency_ms: float | None
+    max_buffer: int
+
+
+@dataclass
+class SoakReport:
+    samples: list[SoakSample] = field(default_factory=list)
+    failures: list[str] = field(default_factory=list)
+
+    @property
+    def passed(self):
+        return not self.failures
+
+
+def _rss_bytes() -> int | None:
+    """当前常驻内存，只在有 /proc 的系统上可用"""
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class SyntheticPlayer:
+    """按概率切歌、暂停、停止的假播放器，生成和 beefweb 一样结构的 player 数据"""
+
+    def __init__(self, config: SoakConfig, rng: random.Random):
+        self._config = config
+        self._rng = rng
+        self._state: PlaybackState = "stopped"
+        self._index = -1
+        self._position = 0.0
+        self._last_time = time.perf_counter()
+        self._switch()
+
+    def _length(self):
+        return 60.0 + self._index % 240
+
+    def _step(self):
+        now = time.perf_counter()
+        if self._state == "playing":
+            self._position += now - self._last_time
+        self._last_time = now
+        roll = self._rng.random()
+        config = self._config
+        if self._state == "stopped":
+            if roll < config.switch_probability:
+                self._switch()
+        elif roll < config.stop_probability:
+            self._state = "stopped"
+            self._index = -1
+        elif roll < config.stop_probability + config.switch_probability:
+            self._switch()
+        elif (
+            roll
+            < config.stop_probability
+            + config.switch_probability
+            + config.pause_probability
+        ):
+            self._state = "paused" if self._state == "playing" else "playing"
+        elif self._position >= self._length():
+            self._switch()
+
+    def _switch(self):
+        self._index = self._rng.randrange(self._config.track_count)
+        self._position = 0.0
+        self._state = "playing"
+
+    def next_player(self, columns: list[str]) -> PlayerStateInfo:
+        self._step()
+        stopped = self._index < 0
+        return {
+            "activeItem": {
+                "playlistId": "" if stopped else "p1",
+                "playlistIndex": -1 if stopped else 0,
+                "index": self._index,
+                "position": self._position,
+                "duration": 0.0 if stopped else self._length(),
+                "columns": (
+                    []
+                    if stopped
+                    else [
+                        (
+                            f"{self._length():.6f}"
+                            if c == _LENGTH_FIELD
+                            else f"{c.strip('%')} {self._index}"
+                        )
+                        for c in columns
+                    ]
+                ),
+            },
+            # 收集器用不到 info，拿 version 夹带发送时间用于计算延迟
+            # 跨进程比较，所以用墙上时间
+            "info": {
+                "name": "soak",
+                "title": "soak",
+                "version": str(time.time_ns()),
+                "pluginVersion": "0",
+            },
+            "playbackMode": 0,
+            "playbackModes": [],
+            "playbackState": self._state,
+            "volume": {
+                "isMuted": False,
+                "max": 0.0,
+                "min": -100.0,
+                "type": "db",
+                "value": 0.0,
+            },
+            "options": [],
+        }
+
+
+class SyntheticServer:
+    """在本地模拟 beefweb 的 query/updates 接口，运行在单独的进程里"""
+
+    def __init__(self, config: SoakConfig, events: Synchronized):
+        self._config = config
+        self._rng = random.Random(config.seed)
+        self._player = SyntheticPlayer(config, self._rng)
+        self._runner: web.AppRunner | None = None
+        self._events = events
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get("/api/query/updates", self._updates)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}/api"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _updates(self, request: web.Request):
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        columns = request.query.get("trcolumns", "").split(",")
+        rate = self._config.events_per_second
+        max_batch = max(1, int(rate * _TICK * _MAX_CATCHUP_TICKS))
+        start = time.perf_counter()
+        sent = 0
+        try:
+            while True:
+                # 收集器跟不上时就认了，不去补之前欠下的事件
+                target = int((time.perf_counter() - start) * rate)
+                sent = max(sent, target - max_batch)
+                lines = []
+                disconnect = False
+                for _ in range(target - sent):
+                    if self._rng.random() < self._config.disconnect_probability:
+                        disconnect = True
+                        break
+                    player = self._player.next_player(columns)
+                    lines.append(f"data: {json.dumps({"player": player})}\n\n")
+                if lines:
+                    await resp.write("".join(lines).encode("utf-8"))
+                    with self._events.get_lock():
+                        self._events.value += len(lines)
+                if disconnect:
+                    break
+                sent = target
+                await asyncio.sleep(_TICK)
+        except ConnectionResetError:
+            # 收集器那边先断开了
+            pass
+        return resp
+
+
+def _serve(config: SoakConfig, conn: Connection, stop: EventType, events: Synchronized):
+    """子进程入口，把服务器地址通过 conn 发回去，stop 被设置后退出"""
+
+    async def serve():
+        server = SyntheticServer(config, events)
+        conn.send(await server.start())
+        conn.close()
+        try:
+            while not stop.is_set():
+                await asyncio.sleep(0.1)
+        finally:
+            await server.stop()
+
+    asyncio.run(serve())
+
+
+class _GeneratorProcess:
+    """
+    合成服务器所在的子进程
+
+    和收集器分开跑，生成和编码事件的 CPU、内存都不会算到收集器头上
+    """
+
+    def __init__(self, config: SoakConfig):
+        ctx = multiprocessing.get_context("spawn")
+        self._events = ctx.Value("q", 0)
+        self._stop = ctx.Event()
+        self._conn, child_conn = ctx.Pipe(duplex=False)
+        self._child_conn = child_conn
+        self._process = ctx.Process(
+            target=_serve,
+            args=(config, child_conn, self._stop, self._events),
+            daemon=True,
+        )
+
+    @property
+    def events(self) -> int:
+        return self._events.value
+
+    async def start(self) -> str:
+        self._process.start()
+        # 关掉自己这边的写端，子进程挂掉时 recv 才会收到 EOFError 而不是一直等
+        self._child_conn.close()
+        return await asyncio.to_thread(self._conn.recv)
+
+    async def stop(self):
+        self._stop.set()
+        if self._process.pid is not None:
+            await asyncio.to_thread(self._process.join, 5)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._conn.close()
+
+
+class _SoakCollector(StatisticCollector):
+    """记录每个事件从发出到处理完的延迟和缓冲区大小的收集器"""
+
+    def __init__(self, config: StatisticConfig):
+        super().__init__(config)
+        self._sent_ns: int | None = None
+        self.latencies: list[float] = []
+        self.max_buffer = 0
+
+    def _player_to_state(self, player: PlayerStateInfo):
+        self._sent_ns = int(player["info"]["version"])
+        return super()._player_to_state(player)
+
+    def _switch_state(self, new_state):
+        super()._switch_state(new_state)
+        if self._sent_ns is not None:
+            self.latencies.append((time.time_ns() - self._sent_ns) / 1e6)
+            self._sent_ns = None
+        self.max_buffer = max(self.max_buffer, len(self._buffer))
+
+    def drain(self):
+        """取出这一个采样周期的统计并清空，免得统计本身让内存涨上去"""
+        latencies, self.latencies = self.latencies, []
+        max_buffer, self.max_buffer = self.max_buffer, len(self._buffer)
+        return latencies, max_buffer
+
+
+def _p99(latencies: list[float]):
+    if len(latencies) < 2:
+        return latencies[0] if latencies else None
+    return statistics.quantiles(latencies, n=100)[98]
+
+
+def _check(config: SoakConfig, report: SoakReport):
+    samples = [s for s in report.samples if s.elapsed >= config.warmup]
+    if len(samples) < 2:
+        report.failures.append("not enough samples after warmup")
+        return
+    # 和最后几次采样里最小的比，避免刚好赶上缓冲区很满的时候
+    baseline, tail = samples[0], samples[-3:]
+    traced_growth = (min(s.traced_bytes for s in tail) - baseline.traced_bytes) / 2**20
+    if traced_growth > config.max_traced_growth_mb:
+        report.failures.append(
+            f"traced memory grew {traced_growth:.2f}MB "
+            f"> {config.max_traced_growth_mb:.2f}MB"
+        )
+    tail_rss = [s.rss_bytes for s in tail if s.rss_bytes is not None]
+    if baseline.rss_bytes is not None and len(tail_rss) == len(tail):
+        rss_growth = (min(tail_rss) - baseline.rss_bytes) / 2**20
+        if rss_growth > config.max_rss_growth_mb:
+            report.failures.append(
+                f"rss grew {rss_growth:.2f}MB > {config.max_rss_growth_mb:.2f}MB"
+            )
+    min_rate = config.events_per_second * config.min_rate_ratio
+    if (slowest := min(s.events_per_second for s in samples)) < min_rate:
+        report.failures.append(
+            f"event rate {slowest:.1f}/s < {min_rate:.1f}/s "
+            f"({config.min_rate_ratio:.0%} of {config.events_per_second:.1f}/s)"
+        )
+    p99s = [s.p99_latency_ms for s in samples if s.p99_latency_ms is not None]
+    if not p99s:
+        report.failures.append("no events processed after warmup")
+    elif (worst := max(p99s)) > config.max_p99_latency_ms:
+        report.failures.append(
+            f"p99 latency {worst:.2f}ms > {config.max_p99_latency_ms:.2f}ms"
+        )
+
+
+async def run_soak(config: SoakConfig) -> SoakReport:
+    """
+    用合成的 SSE 服务器长时间喂收集器，定期采样内存和事件延迟
+
+    服务器跑在子进程里，采到的内存、延迟只属于收集器
+    收集器每个事件都会打 info 日志，为了不刷屏运行期间把它的日志级别调到 WARNING
+    """
+    report = SoakReport()
+    server = _GeneratorProcess(config)
+    collector_logger = logging.getLogger(StatisticCollector.__module__)
+    old_level = collector_logger.level
+    collector_logger.setLevel(logging.WARNING)
+    tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            api_root = await server.start()
+            collector = _SoakCollector(
+                StatisticConfig(
+                    api_root=api_root,
+                    database_url=f"sqlite:///{os.path.join(tmpdir, "soak.db")}",
+                    retry_interval=0.0,
+                )
+            )
+            task = asyncio.create_task(collector.collect_forever())
+            start = time.perf_counter()
+            last_elapsed, last_events = 0.0, 0
+            try:
+                while time.perf_counter() - start < config.duration:
+                    await asyncio.sleep(config.sample_interval)
+                    if task.done():
+                        report.failures.append("collector stopped unexpectedly")
+                        break
+                    latencies, max_buffer = collector.drain()
+                    elapsed, events = time.perf_counter() - start, server.events
+                    sample = SoakSample(
+                        elapsed=elapsed,
+                        events=events,
+                        events_per_second=(
+                            (events - last_events) / (elapsed - last_elapsed)
+                        ),
+                        traced_bytes=tracemalloc.get_traced_memory()[0],
+                        rss_bytes=_rss_bytes(),
+                        p99_latency_ms=_p99(latencies),
+                        max_buffer=max_buffer,
+                    )
+                    report.samples.append(sample)
+                    logger.info("soak sample: %s", sample)
+                    last_elapsed, last_events = elapsed, events
+            finally:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                await collector.close()
+    finally:
+        await server.stop()
+        tracemalloc.stop()
+        collector_logger.setLevel(old_level)
+    _check(config, report)
+    for failure in report.failures:
+        logger.error("soak failed: %s", failure)
+    if report.passed:
+        logger.info("soak passed")
+    return report
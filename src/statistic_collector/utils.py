@@ -3,8 +3,8 @@ import functools
 import re
 import hashlib
 import asyncio
-from typing import TypeVar, ParamSpec, Protocol
-from collections.abc import Awaitable
+from typing import Any, TypeVar, ParamSpec, Protocol
+from collections.abc import Awaitable, Coroutine
 
 
 ###### From Meloland/melobot by @aicorein, modified ######
@@ -20,11 +20,15 @@ class AsyncCallable(Protocol[P, T_co]):
     def __call__(self, *args: P.args, **kwargs: P.kwargs) -> Awaitable[T_co]: ...
 
 
-def lock() -> Callable[[AsyncCallable[P, T]], AsyncCallable[P, T]]:
+def lock() -> (
+    Callable[[Callable[P, Awaitable[T]]], Callable[P, Coroutine[Any, Any, T]]]
+):
     """锁装饰器"""
     alock = asyncio.Lock()
 
-    def deco_func(func: AsyncCallable[P, T]) -> AsyncCallable[P, T]:
+    def deco_func(
+        func: Callable[P, Awaitable[T]],
+    ) -> Callable[P, Coroutine[Any, Any, T]]:
 
         @functools.wraps(func)
         async def wrapped_func(*args: P.args, **kwargs: P.kwargs) -> T:
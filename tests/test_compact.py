@@ -0,0 +1,146 @@
+import time
+
+import pytest
+from sqlmodel import Session, select
+
+from src.statistic_collector import RecordCompactor, StatisticConfig
+from src.statistic_collector.database import create_db_engine
+from src.statistic_collector.models import (
+    CompactionCheckpoint,
+    MusicItem,
+    PlaybackFragment,
+    PlaybackRecord,
+)
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    return f"sqlite:///{tmp_path / 'statistic.db'}"
+
+
+@pytest.fixture
+def engine(database_url):
+    engine = create_db_engine(database_url)
+    with Session(engine) as session:
+        for music_id in ("a", "b"):
+            session.add(MusicItem(id=music_id, title=music_id, duration=300.0))
+        session.commit()
+    yield engine
+    engine.dispose()
+
+
+def make_compactor(database_url: str, threshold: float, batch_size: int = 2):
+    return RecordCompactor(
+        StatisticConfig(
+            database_url=database_url,
+            compact_gap_threshold=threshold,
+            compact_batch_size=batch_size,
+        )
+    )
+
+
+def add_records(engine, base: float, *records: tuple[str, float, float]):
+    with Session(engine) as session:
+        for music_id, offset, duration in records:
+            session.add(
+                PlaybackRecord(music_id=music_id, time=base + offset, duration=duration)
+            )
+        session.commit()
+
+
+def dump(engine, base: float):
+    """按时间顺序返回 (music_id, 相对开始时间, 时长, 片段列表)"""
+    with Session(engine) as session:
+        records = session.exec(select(PlaybackRecord).order_by(PlaybackRecord.time))
+        return [
+            (
+                r.music_id,
+                r.time - base,
+                r.duration,
+                sorted((f.time - base, f.duration) for f in r.fragments),
+            )
+            for r in records
+        ]
+
+
+def orphan_fragments(engine):
+    with Session(engine) as session:
+        record_ids = set(session.exec(select(PlaybackRecord.id)).all())
+        fragments = session.exec(select(PlaybackFragment)).all()
+        return [f for f in fragments if f.record_id not in record_ids]
+
+
+def test_merge_interleaved_tracks_across_batches(engine, database_url):
+    base = time.time() - 10000
+    add_records(
+        engine,
+        base,
+        ("a", 0, 30),
+        ("b", 40, 5),
+        ("a", 35, 20),
+        ("b", 50, 5),
+        ("a", 60, 10),
+        ("a", 200, 10),
+    )
+
+    result = make_compactor(database_url, threshold=10).compact()
+
+    assert (result.scanned, result.merged) == (6, 3)
+    assert dump(engine, base) == [
+        ("a", 0, 60, [(0, 30), (35, 20), (60, 10)]),
+        ("b", 40, 10, [(40, 5), (50, 5)]),
+        ("a", 200, 10, []),
+    ]
+    assert not orphan_fragments(engine)
+
+
+def test_rerun_without_new_records_changes_nothing(engine, database_url):
+    base = time.time() - 10000
+    add_records(engine, base, ("a", 0, 30), ("a", 35, 20))
+    compactor = make_compactor(database_url, threshold=10)
+    compactor.compact()
+    before = dump(engine, base)
+
+    result = compactor.compact()
+
+    assert (result.scanned, result.merged) == (0, 0)
+    assert dump(engine, base) == before
+
+
+def test_open_chain_is_kept_in_checkpoint(engine, database_url):
+    # 链尾离现在不到阈值，下次运行还可能接上新记录
+    base = time.time() - 20
+    add_records(engine, base, ("a", 0, 5), ("a", 8, 5))
+    compactor = make_compactor(database_url, threshold=60)
+    first = compactor.compact()
+    assert first.checkpoint == pytest.approx(base)
+
+    add_records(engine, base, ("a", 30, 5))
+    second = compactor.compact()
+
+    assert (second.scanned, second.merged) == (2, 1)
+    assert dump(engine, base) == [("a", 0, 15, [(0, 5), (8, 5), (30, 5)])]
+    assert not orphan_fragments(engine)
+
+
+def test_threshold_change_recompacts_and_reparents_fragments(engine, database_url):
+    base = time.time() - 10000
+    add_records(
+        engine, base, ("a", 0, 30), ("a", 35, 20), ("a", 100, 10), ("a", 115, 10)
+    )
+    make_compactor(database_url, threshold=10).compact()
+    assert dump(engine, base) == [
+        ("a", 0, 50, [(0, 30), (35, 20)]),
+        ("a", 100, 20, [(100, 10), (115, 10)]),
+    ]
+
+    result = make_compactor(database_url, threshold=60).compact()
+
+    assert result.merged == 1
+    assert dump(engine, base) == [
+        ("a", 0, 70, [(0, 30), (35, 20), (100, 10), (115, 10)]),
+    ]
+    assert not orphan_fragments(engine)
+    with Session(engine) as session:
+        checkpoint = session.exec(select(CompactionCheckpoint)).one()
+        assert checkpoint.gap_threshold == 60
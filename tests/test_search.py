@@ -0,0 +1,60 @@
+import pytest
+from sqlmodel import Session
+
+from src.statistic_collector import MusicSearchIndex, StatisticConfig
+from src.statistic_collector.database import create_db_engine
+from src.statistic_collector.models import MusicItem, PlaybackRecord
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'statistic.db'}")
+    yield engine
+    engine.dispose()
+
+
+def add_music(engine, index: MusicSearchIndex | None, music_id: str, title: str):
+    with Session(engine) as session:
+        session.add(MusicItem(id=music_id, title=title, duration=200.0))
+        if index is not None:
+            index.add(session, music_id)
+        session.commit()
+
+
+def titles(results):
+    return [r.music.title for r in results]
+
+
+def test_ensure_rebuilds_after_items_added_while_disabled(engine):
+    index = MusicSearchIndex(engine, "trigram")
+    assert index.ensure()
+    add_music(engine, index, "1", "Indexed Song")
+    # 关掉搜索期间收集器不会同步索引
+    add_music(engine, None, "2", "Unindexed Song")
+
+    index = MusicSearchIndex(engine, "trigram")
+    assert index.ensure()
+
+    assert sorted(titles(index.search("Song"))) == ["Indexed Song", "Unindexed Song"]
+
+
+def test_cjk_substring_and_short_terms(engine):
+    index = MusicSearchIndex(engine, "trigram")
+    assert index.ensure()
+    add_music(engine, index, "1", "千本桜")
+    add_music(engine, index, "2", "夜桜")
+    add_music(engine, index, "3", "桜a")
+    with Session(engine) as session:
+        session.add(PlaybackRecord(music_id="2", time=0.0, duration=10.0))
+        session.commit()
+
+    assert titles(index.search("千本桜")) == ["千本桜"]
+    # 少于三个字符走 LIKE，按播放次数再按标题排序
+    results = index.search("桜")
+    assert titles(results) == ["夜桜", "千本桜", "桜a"]
+    assert [r.play_count for r in results] == [1, 0, 0]
+
+
+def test_from_config_requires_tokenizer():
+    with pytest.raises(ValueError):
+        MusicSearchIndex.from_config(StatisticConfig())